@@ -4,65 +4,131 @@ Shared Terminal Web Service with Full Terminal Emulation
 A service that provides a shared terminal interface with proper ANSI handling.
 """
 
+# Patch the standard library before anything else imports it, so that the
+# script thread, selectors and sockets all cooperate on the gevent hub
+from gevent import monkey
+monkey.patch_all()
+
 import argparse
+import concurrent.futures
+import fcntl
+import hashlib
 import os
 import pty
-import select
+import selectors
+import struct
 import subprocess
+import termios
 import threading
 import time
-import base64
-from datetime import datetime
-from flask import Flask, render_template, request
-from flask_socketio import SocketIO, emit
+import gevent
+from flask import Flask, Response, render_template, request
+from flask_socketio import SocketIO, emit, join_room
 import signal
 import sys
 
 app = Flask(__name__, static_folder='static', static_url_path='/static')
-socketio = SocketIO(app, cors_allowed_origins="*")
+# Let browsers reuse the static assets for 60 seconds instead of
+# revalidating every script on each page load
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 60
+socketio = SocketIO(app, async_mode='gevent', cors_allowed_origins="*")
+
+# Script output is coalesced into one message per FLUSH_INTERVAL seconds, or
+# sooner once FLUSH_SIZE bytes are pending; no message exceeds MAX_EMIT_SIZE
+FLUSH_INTERVAL = 0.025
+FLUSH_SIZE = 16 * 1024
+MAX_EMIT_SIZE = 64 * 1024
+# Every connected client joins this room and all broadcasts go to it
+VIEWERS_ROOM = 'viewers'
+
+# Terminal messages, pre-encoded so only the variable part is formatted
+ALREADY_RUNNING_MSG = b'\r\n\x1b[31mScript is already running!\x1b[0m\r\n'
+START_MSG = b'\r\n\x1b[32m=== Starting %s ===\x1b[0m\r\n'
+COMPLETION_MSG = b'\r\n\x1b[32m=== Script completed with return code: %d ===\x1b[0m\r\n'
+ERROR_MSG = b'\r\n\x1b[31mError running script: %s\x1b[0m\r\n'
 
 class TerminalState:
     def __init__(self):
-        self.is_running = False
+        # Set while the script runs; reading it needs no lock
+        self.running = threading.Event()
         self.process = None
         self.master_fd = None
         self.lock = threading.Lock()
-        # Store raw terminal data for proper terminal emulation
-        self.terminal_data = b''
+        # Store raw terminal data for proper terminal emulation in a fixed
+        # 1MB ring buffer, so appends never reallocate or copy old output
+        self.buffer = bytearray(1024 * 1024)
+        self.head = 0
+        self.size = 0
+        # In-order copy of the buffer, built on demand and dropped on every change
+        self._snapshot = None
         
+    @property
+    def is_running(self):
+        return self.running.is_set()
+    
     def add_data(self, data):
         """Add raw terminal data (bytes)"""
         with self.lock:
-            self.terminal_data += data
-            # Keep only last 1MB to prevent memory issues
-            if len(self.terminal_data) > 1024 * 1024:
-                # Keep last 512KB
-                self.terminal_data = self.terminal_data[-512*1024:]
+            capacity = len(self.buffer)
+            data = memoryview(data)[-capacity:]
+            view = memoryview(self.buffer)
+            # Copy up to the end of the buffer, then wrap around to the start
+            first = min(len(data), capacity - self.head)
+            view[self.head:self.head + first] = data[:first]
+            view[:len(data) - first] = data[first:]
+            self.head = (self.head + len(data)) % capacity
+            self.size = min(self.size + len(data), capacity)
+            self._snapshot = None
+    
+    def _ordered_data(self):
+        """Return buffered data oldest-first. Caller must hold the lock."""
+        start = (self.head - self.size) % len(self.buffer)
+        if start + self.size <= len(self.buffer):
+            return self.buffer[start:start + self.size]
+        return self.buffer[start:] + self.buffer[:self.head]
     
     def get_terminal_data(self):
-        """Get all terminal data as base64 for transmission"""
+        """Get all terminal data as raw bytes for transmission"""
         with self.lock:
-            return base64.b64encode(self.terminal_data).decode('ascii')
+            if self._snapshot is None:
+                self._snapshot = bytes(self._ordered_data())
+            return self._snapshot
     
     def clear_data(self):
         with self.lock:
-            self.terminal_data = b''
+            self.head = 0
+            self.size = 0
+            self._snapshot = None
 
 terminal_state = TerminalState()
+# A single worker runs the script; script_future is the current run, if any
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='script')
+script_future = None
+script_lock = threading.Lock()
 SCRIPT_PATH = None
 RUN_ON_PAGE_LOAD = False
+# The page only depends on startup options, so it is rendered once
+INDEX_HTML = None
+INDEX_ETAG = None
 
 @app.route('/')
 def index():
-    if RUN_ON_PAGE_LOAD and not terminal_state.is_running:
-        thread = threading.Thread(target=run_script_thread)
-        thread.daemon = True
-        thread.start()
-    return render_template("index.html", title=CUSTOM_TITLE, header=CUSTOM_HEADER)
+    global INDEX_HTML, INDEX_ETAG
+    if RUN_ON_PAGE_LOAD:
+        start_script()
+    if INDEX_HTML is None:
+        INDEX_HTML = render_template("index.html", title=CUSTOM_TITLE, header=CUSTOM_HEADER).encode('utf-8')
+        INDEX_ETAG = hashlib.md5(INDEX_HTML).hexdigest()
+    response = Response(INDEX_HTML, mimetype='text/html')
+    # Browsers must still revalidate, so every page load reaches this view
+    response.headers['Cache-Control'] = 'no-cache'
+    response.set_etag(INDEX_ETAG)
+    return response.make_conditional(request)
 
 @socketio.on('connect')
 def handle_connect():
     print(f"Client connected: {request.sid}")
+    join_room(VIEWERS_ROOM)
     # Send current button state
     emit('button_state', {'disabled': terminal_state.is_running})
 
@@ -74,50 +140,81 @@ def handle_disconnect():
 def handle_request_state():
     # Send current terminal data to newly connected client
     terminal_data = terminal_state.get_terminal_data()
-    emit('full_terminal_data', {'data': terminal_data})
+    emit('full_terminal_data', terminal_data)
     emit('button_state', {'disabled': terminal_state.is_running})
 
 @socketio.on('run_script')
 def handle_run_script():
-    if terminal_state.is_running:
+    if not start_script():
         # Send error message through terminal
-        error_msg = '\r\n\x1b[31mScript is already running!\x1b[0m\r\n'
-        error_data = base64.b64encode(error_msg.encode()).decode('ascii')
-        emit('terminal_data', {'data': error_data})
-        return
-    
-    # Start the script in a new thread
-    thread = threading.Thread(target=run_script_thread)
-    thread.daemon = True
-    thread.start()
+        emit('terminal_data', ALREADY_RUNNING_MSG)
 
 @socketio.on('clear_terminal')
 def handle_clear_terminal():
     terminal_state.clear_data()
-    socketio.emit('terminal_cleared')
+    socketio.emit('terminal_cleared', to=VIEWERS_ROOM)
+
+def start_script():
+    """Start the script on the worker unless a run is already in progress."""
+    global script_future
+    with script_lock:
+        if script_future is not None and not script_future.done():
+            return False
+        script_future = executor.submit(run_script_thread)
+        return True
+
+def broadcast_data(data):
+    """Record raw terminal data and send it to all clients.
+    
+    History is only updated here, so the snapshot sent to joining clients is
+    rebuilt at most once per flush and never overlaps a later broadcast.
+    Messages are split to at most MAX_EMIT_SIZE bytes.
+    """
+    terminal_state.add_data(data)
+    for start in range(0, len(data), MAX_EMIT_SIZE):
+        socketio.emit('terminal_data', bytes(data[start:start + MAX_EMIT_SIZE]), to=VIEWERS_ROOM)
+
+def drain_fd(fd, buffer):
+    """Read everything a non-blocking fd has buffered into buffer, until full.
+    
+    Returns a memoryview of the data read, valid until buffer is reused, and
+    whether the fd has been closed (EOF or EIO).
+    """
+    view = memoryview(buffer)
+    size = 0
+    while size < len(view):
+        try:
+            count = os.readv(fd, [view[size:]])
+        except BlockingIOError:
+            return view[:size], False
+        except OSError:
+            return view[:size], True
+        if not count:
+            return view[:size], True
+        size += count
+    return view[:size], False
 
 def run_script_thread():
     """Run the script in a separate thread with full PTY support."""
     
-    terminal_state.is_running = True
-    socketio.emit('script_started')
+    terminal_state.running.set()
+    socketio.emit('script_started', to=VIEWERS_ROOM)
+    selector = None
+    pidfd = None
     
     try:
         # Create a pseudo-terminal for proper ANSI handling
         master_fd, slave_fd = pty.openpty()
         terminal_state.master_fd = master_fd
+        os.set_blocking(master_fd, False)
         
         # Set terminal size (important for applications like vim, tmux)
-        os.system(f'stty -F {os.ttyname(slave_fd)} rows 30 cols 120')
+        fcntl.ioctl(slave_fd, termios.TIOCSWINSZ, struct.pack('HHHH', 30, 120, 0, 0))
         
         script_path = SCRIPT_PATH
             
         # Start message
-        start_msg = f'\r\n\x1b[32m=== Starting {script_path} ===\x1b[0m\r\n'
-        terminal_state.add_data(start_msg.encode())
-        socketio.emit('terminal_data', {
-            'data': base64.b64encode(start_msg.encode()).decode('ascii')
-        })
+        broadcast_data(START_MSG % os.fsencode(script_path))
         
         # Set environment variables for proper terminal behavior
         env = os.environ.copy()
@@ -132,7 +229,8 @@ def run_script_thread():
             stdout=slave_fd,
             stderr=slave_fd,
             env=env,
-            preexec_fn=os.setsid
+            close_fds=True,
+            start_new_session=True
         )
         
         terminal_state.process = process
@@ -140,77 +238,104 @@ def run_script_thread():
         # Close slave fd in parent process
         os.close(slave_fd)
         
-        # Read output from master fd and broadcast to all clients
-        while process.poll() is None:
+        # Wait on the PTY and, on Linux, a pidfd for the child so the loop
+        # sleeps until there is output or the script exits instead of polling
+        selector = selectors.DefaultSelector()
+        selector.register(master_fd, selectors.EVENT_READ)
+        timeout = 0.1
+        if sys.platform.startswith('linux') and hasattr(os, 'pidfd_open'):
             try:
-                # Use select to check if data is available
-                ready, _, _ = select.select([master_fd], [], [], 0.1)
-                if ready:
-                    try:
-                        data = os.read(master_fd, 4096)  # Read larger chunks
-                        if data:
-                            # Store raw data
-                            terminal_state.add_data(data)
-                            # Send to all connected clients
-                            socketio.emit('terminal_data', {
-                                'data': base64.b64encode(data).decode('ascii')
-                            })
-                    except OSError:
-                        break
-            except select.error:
+                pidfd = os.pidfd_open(process.pid)
+                selector.register(pidfd, selectors.EVENT_READ)
+                timeout = None
+            except OSError:
+                pass
+        
+        # Read output from master fd and broadcast to all clients
+        pending = bytearray()
+        read_buffer = bytearray(MAX_EMIT_SIZE)
+        last_flush = time.monotonic()
+        while True:
+            wait = timeout
+            if pending:
+                # Wake up in time to flush what is already pending
+                wait = max(0, last_flush + FLUSH_INTERVAL - time.monotonic())
+                if timeout is not None:
+                    wait = min(wait, timeout)
+            ready = {key.fd for key, _ in selector.select(wait)}
+            if master_fd in ready:
+                # Drain the PTY rather than selecting again after every read
+                data, closed = drain_fd(master_fd, read_buffer)
+                pending += data
+                if closed:
+                    break
+            # The pidfd becoming readable means the script has exited, so
+            # only fall back to polling waitpid when there is no pidfd
+            if pidfd in ready or (pidfd is None and process.poll() is not None):
                 break
+            # Send to all connected clients once the batch is due
+            now = time.monotonic()
+            if pending and (len(pending) >= FLUSH_SIZE or now - last_flush >= FLUSH_INTERVAL):
+                broadcast_data(pending)
+                pending.clear()
+                last_flush = now
         
-        # Wait for process to complete
+        # Reap the process, which has exited unless the PTY closed first
         return_code = process.wait()
         
         # Read any remaining output
-        try:
-            remaining_data = os.read(master_fd, 4096)
-            if remaining_data:
-                terminal_state.add_data(remaining_data)
-                socketio.emit('terminal_data', {
-                    'data': base64.b64encode(remaining_data).decode('ascii')
-                })
-        except OSError:
-            pass
+        while len(pending) < 1024 * 1024:
+            remaining_data, closed = drain_fd(master_fd, read_buffer)
+            pending += remaining_data
+            if closed or len(remaining_data) < len(read_buffer):
+                break
+        if pending:
+            broadcast_data(pending)
         
         # Emit completion message
-        completion_msg = f'\r\n\x1b[32m=== Script completed with return code: {return_code} ===\x1b[0m\r\n'
-        terminal_state.add_data(completion_msg.encode())
-        socketio.emit('terminal_data', {
-            'data': base64.b64encode(completion_msg.encode()).decode('ascii')
-        })
+        broadcast_data(COMPLETION_MSG % return_code)
         
     except Exception as e:
-        error_msg = f'\r\n\x1b[31mError running script: {str(e)}\x1b[0m\r\n'
-        terminal_state.add_data(error_msg.encode())
-        socketio.emit('terminal_data', {
-            'data': base64.b64encode(error_msg.encode()).decode('ascii')
-        })
+        broadcast_data(ERROR_MSG % str(e).encode())
     
     finally:
         # Cleanup
+        if selector:
+            selector.close()
+        if pidfd is not None:
+            os.close(pidfd)
         if terminal_state.master_fd:
             try:
                 os.close(terminal_state.master_fd)
             except OSError:
                 pass
         
-        terminal_state.is_running = False
+        terminal_state.running.clear()
         terminal_state.process = None
         terminal_state.master_fd = None
-        socketio.emit('script_finished')
+        socketio.emit('script_finished', to=VIEWERS_ROOM)
 
 
 def signal_handler(sig, frame):
     """Handle shutdown gracefully."""
     print("\nShutting down gracefully...")
-    if terminal_state.process:
+    process = terminal_state.process
+    if process:
         try:
-            os.killpg(os.getpgid(terminal_state.process.pid), signal.SIGTERM)
+            pgid = os.getpgid(process.pid)
+            os.killpg(pgid, signal.SIGTERM)
+            try:
+                process.wait(timeout=1)
+            except subprocess.TimeoutExpired:
+                # The script ignored SIGTERM, so stop it for good
+                os.killpg(pgid, signal.SIGKILL)
         except ProcessLookupError:
             pass
-    sys.exit(0)
+    executor.shutdown(wait=False, cancel_futures=True)
+    # The executor's worker is joined at interpreter exit, so sys.exit()
+    # would wait for the run to finish; leave without waiting instead
+    sys.stdout.flush()
+    os._exit(0)
 
 
 if __name__ == '__main__':
@@ -226,9 +351,10 @@ if __name__ == '__main__':
     SCRIPT_PATH = args.scriptname
     RUN_ON_PAGE_LOAD = args.run_on_page_load
 
-    # Set up signal handlers
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
+    # Set up signal handlers; gevent runs each in its own greenlet, so the
+    # handler may wait on the script without blocking the event loop
+    gevent.signal_handler(signal.SIGINT, signal_handler, signal.SIGINT, None)
+    gevent.signal_handler(signal.SIGTERM, signal_handler, signal.SIGTERM, None)
     
     print("Sharing script {}".format(SCRIPT_PATH))
     print("Press Ctrl+C to stop the server")